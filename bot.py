@@ -1,27 +1,113 @@
 
-import re
 import time
 import threading
-from collections import deque, defaultdict
-from typing import Optional
-
+import atexit
+import functools
+import queue
+import signal
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Tuple
+
+import requests
 import telebot
+from requests.adapters import HTTPAdapter
 from telebot import apihelper
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.retry import Retry
 
-from config import TOKEN, BOT_USERNAME, STORAGE_CHAT_ID, ADMIN_USER_IDS, OWNER_ID, RATE_LIMIT_MAX_FILES, RATE_LIMIT_WINDOW_SEC, EXPIRE_CHECK_INTERVAL_SEC, DB_JSON_PATH, DEBUG
+from config import TOKEN, BOT_USERNAME, STORAGE_CHAT_ID, ADMIN_USER_IDS, CHAT_WORKERS, RATE_LIMIT_MAX_FILES, RATE_LIMIT_WINDOW_SEC, BROADCAST_RATE_PER_SEC, BROADCAST_CONCURRENCY, STORAGE_COPY_MAX_RETRIES, EXPIRE_CHECK_INTERVAL_SEC, DB_PATH, DB_JSON_PATH, WRITEBACK_INTERVAL_SEC, WRITEBACK_MAX_PENDING, DEBUG
 from database import Database
-from utils import gen_code, now_str, parse_expiry, detect_category, format_entry_line
+from utils import gen_code, now_epoch, fmt_epoch, parse_expiry, detect_category, format_entry_line, is_valid_code, RateLimiter, ChatLanes
+
+# One pooled HTTP session shared by all threads, so API calls reuse
+# keep-alive TLS connections instead of handshaking per call/thread.
+# Only failed connects are retried: telebot sends copyMessage & co. as GET, so
+# replaying after a read error or 5xx could deliver a message twice.
+# 429s are handled by callers.
+api_session = requests.Session()
+api_session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.2),
+))
+apihelper.session = api_session
+
+# Needed for @bot.middleware_handler; must be set before the bot is created
+apihelper.ENABLE_MIDDLEWARE = True
+
+# Polling thread only matches handlers; the work itself runs on chat lanes
+bot = telebot.TeleBot(TOKEN, parse_mode='HTML', threaded=False)
+chat_lanes = ChatLanes(CHAT_WORKERS)
+db = Database(
+    DB_PATH,
+    legacy_json_path=DB_JSON_PATH,
+    writeback_interval=WRITEBACK_INTERVAL_SEC,
+    writeback_max_pending=WRITEBACK_MAX_PENDING,
+)
+atexit.register(db.checkpoint)
+
+# Rate limiter (token bucket): user_id -> (tokens, last_refill)
+rate_buckets: Dict[int, Tuple[float, float]] = {}
+RATE_REFILL_PER_SEC = RATE_LIMIT_MAX_FILES / RATE_LIMIT_WINDOW_SEC
+_last_rate_evict = 0.0
+
+# Shared pacing for broadcasts (Telegram global flood limit)
+broadcast_limiter = RateLimiter(BROADCAST_RATE_PER_SEC)
+BROADCAST_PROGRESS_EVERY = 500
+
+# Storage copies run on a background worker: (code, chat_id, message_id, future)
+storage_queue: 'queue.Queue[Tuple[str, int, int, Future]]' = queue.Queue()
+# code -> Future[storage_message_id] while its storage copy is in flight
+pending_storage: Dict[str, Future] = {}
+
+GET_CMD_PREFIX = '/get_'
+
+DEEP_LINK_PREFIX = f"https://t.me/{BOT_USERNAME}?start=get_"
+
+SAVED_MSG_TMPL = '✅ Saved!\nCode: <code>{0}</code>\nRetrieve: <code>/get_{0}</code>\nLink: {1}{0}'
+
+WELCOME_TEXT = """
+<b>Welcome!</b>
+Send me any file/media (photo, video, audio, document, zip, pdf, etc.) and I'll save it securely.
+I'll reply with a unique code and a retrieval link.
 
-bot = telebot.TeleBot(TOKEN, parse_mode='HTML')
-db = Database(DB_JSON_PATH)
+Retrieve: <code>/get_&lt;code&gt;</code> or tap the link I provide.
 
-# Rate limiter: user_id -> deque of timestamps
-rate_buckets = defaultdict(lambda: deque(maxlen=RATE_LIMIT_MAX_FILES))
+Useful commands:
+• /my_files — list your files
+• /list images|videos|audio|documents|zip|other — list by category
+• /list user &lt;user_id&gt; — list files by user
+• /search &lt;keyword&gt; — search by type/name/caption
+• /lock_code &lt;code&gt; — lock a code to your account
+• /rename_code &lt;old&gt; &lt;new&gt; — rename your code
+• /expire &lt;code&gt; &lt;duration|never|delete&gt; — set expiry (e.g., 24h, 7d)
 
-GET_CMD_REGEX = re.compile(r'^/get_([a-zA-Z0-9]+)$')
+Admin only:
+• /all_files_count, /all_users_count
+• /delete_code &lt;code&gt;
+• /delete_user &lt;user_id&gt;
+• /storage_clean
+• /broadcast &lt;text&gt;
+        """
+
+@bot.middleware_handler(update_types=['message'])
+def prepare_message(bot_instance, message):
+    # Tokenize once per update instead of once per handler
+    message.tokens = (message.text or '').split()
+    message.is_admin = message.from_user is not None and message.from_user.id in ADMIN_USER_IDS
 
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_USER_IDS
+def _run_handler(handler, message):
+    try:
+        handler(message)
+    except Exception:
+        telebot.logger.exception('%s failed', handler.__name__)
+
+def per_chat(handler):
+    """Run a handler on its chat's lane: FIFO within a chat, parallel across chats."""
+    @functools.wraps(handler)
+    def wrapper(message):
+        chat_lanes.submit(message.chat.id, _run_handler, handler, message)
+    return wrapper
 
 def send_error(chat_id: int, text: str = '❌ Error: File not found or expired.'):
     try:
@@ -29,19 +115,12 @@ def send_error(chat_id: int, text: str = '❌ Error: File not found or expired.'
     except Exception:
         pass
 
-def deep_link_for(code: str) -> str:
-    return f"https://t.me/{BOT_USERNAME}?start=get_{code}"
-
-def save_file_entry(user_id: int, file_type: str, file_id: str, storage_message_id: int, mime_type: Optional[str] = None, file_name: Optional[str] = None, caption: Optional[str] = None) -> str:
-    # ensure unique code
-    code = gen_code()
-    while db.has_code(code):
-        code = gen_code()
+def save_file_entry(user_id: int, file_type: str, file_id: str, storage_message_id: Optional[int], mime_type: Optional[str] = None, file_name: Optional[str] = None, caption: Optional[str] = None) -> str:
     entry = {
         'file_id': file_id,
         'file_type': file_type,
         'uploader': user_id,
-        'uploaded_at': now_str(),
+        'uploaded_at': now_epoch(),
         'expires_at': None,
         'storage_message_id': storage_message_id,
         'category': detect_category(file_type, mime_type, file_name),
@@ -50,32 +129,41 @@ def save_file_entry(user_id: int, file_type: str, file_id: str, storage_message_
         'caption': caption,
         'mime_type': mime_type,
     }
-    db.put_code(code, entry)
+    code = db.insert_new_code(entry, gen_code)
     db.inc_upload(user_id, 1)
     return code
 
+# file_type -> bot.send_* for re-sending by file_id
+SEND_FUNCS = {
+    'photo': bot.send_photo,
+    'video': bot.send_video,
+    'document': bot.send_document,
+    'audio': bot.send_audio,
+    'voice': bot.send_voice,
+    'animation': bot.send_animation,
+    'sticker': bot.send_sticker,
+}
+
+# file_type -> (keep mime_type, keep file_name) when saving an upload
+MEDIA_FIELDS = {
+    'photo': (False, False),
+    'video': (True, False),
+    'document': (True, True),
+    'audio': (True, True),
+    'voice': (False, False),
+    'animation': (True, False),
+    'sticker': (False, False),
+}
+
 def try_send_by_file_id(chat_id: int, entry: dict) -> bool:
     ft = entry.get('file_type')
     fid = entry.get('file_id')
-    cap = entry.get('caption')
     try:
-        if ft == 'photo':
-            bot.send_photo(chat_id, fid, caption=cap)
-        elif ft == 'video':
-            bot.send_video(chat_id, fid, caption=cap)
-        elif ft == 'document':
-            bot.send_document(chat_id, fid, caption=cap)
-        elif ft == 'audio':
-            bot.send_audio(chat_id, fid, caption=cap)
-        elif ft == 'voice':
-            bot.send_voice(chat_id, fid, caption=cap)
-        elif ft == 'animation':
-            bot.send_animation(chat_id, fid, caption=cap)
-        elif ft == 'sticker':
+        if ft == 'sticker':
             bot.send_sticker(chat_id, fid)
         else:
-            # Fallback
-            bot.send_document(chat_id, fid, caption=cap)
+            # Unknown types fall back to document
+            SEND_FUNCS.get(ft, bot.send_document)(chat_id, fid, caption=entry.get('caption'))
         return True
     except apihelper.ApiTelegramException:
         return False
@@ -83,11 +171,19 @@ def try_send_by_file_id(chat_id: int, entry: dict) -> bool:
         return False
 
 def send_from_storage(chat_id: int, entry: dict) -> bool:
+    # copy_message works for every media type in one call; re-sending by
+    # file_id is only a fallback when there is no usable storage copy yet
+    # (the upload is still being copied) or any more.
+    smid = entry.get('storage_message_id')
+    if smid is None:
+        return try_send_by_file_id(chat_id, entry)
     try:
-        smid = entry.get('storage_message_id')
         bot.copy_message(chat_id, STORAGE_CHAT_ID, smid)
         return True
-    except apihelper.ApiTelegramException:
+    except apihelper.ApiTelegramException as e:
+        if e.error_code == 400 and 'not found' in (e.description or '').lower():
+            # Storage message was deleted
+            return try_send_by_file_id(chat_id, entry)
         return False
     except Exception:
         return False
@@ -109,10 +205,7 @@ def handle_retrieval(message, code: str):
         bot.send_message(message.chat.id, '🔒 This file is locked to its owner and cannot be retrieved by you.')
         return
 
-    ok = try_send_by_file_id(message.chat.id, entry)
-    if not ok:
-        # Fallback to copy from storage
-        ok = send_from_storage(message.chat.id, entry)
+    ok = send_from_storage(message.chat.id, entry)
     if ok:
         db.inc_retrieved(message.from_user.id if message.from_user else 0, 1)
     else:
@@ -120,48 +213,25 @@ def handle_retrieval(message, code: str):
 
 # --- Command Handlers ---
 @bot.message_handler(commands=['start'])
+@per_chat
 def on_start(message):
     text = (message.text or '')
     # Deep-link payload: '/start get_<code>' or '/start get_<code>'
-    m = re.search(r'get_([a-zA-Z0-9]+)', text)
-    if m:
-        code = m.group(1)
-        handle_retrieval(message, code)
+    payload = text.partition('get_')[2].split()
+    if payload and is_valid_code(payload[0]):
+        handle_retrieval(message, payload[0])
         return
-    bot.send_message(message.chat.id,
-        """
-<b>Welcome!</b>
-Send me any file/media (photo, video, audio, document, zip, pdf, etc.) and I'll save it securely.
-I'll reply with a unique code and a retrieval link.
-
-Retrieve: <code>/get_&lt;code&gt;</code> or tap the link I provide.
+    bot.send_message(message.chat.id, WELCOME_TEXT)
 
-Useful commands:
-• /my_files — list your files
-• /list images|videos|audio|documents|zip|other — list by category
-• /list user &lt;user_id&gt; — list files by user
-• /search &lt;keyword&gt; — search by type/name/caption
-• /lock_code &lt;code&gt; — lock a code to your account
-• /rename_code &lt;old&gt; &lt;new&gt; — rename your code
-• /expire &lt;code&gt; &lt;duration|never|delete&gt; — set expiry (e.g., 24h, 7d)
-
-Admin only:
-• /all_files_count, /all_users_count
-• /delete_code &lt;code&gt;
-• /delete_user &lt;user_id&gt;
-• /storage_clean
-• /broadcast &lt;text&gt;
-        """
-    )
-
-@bot.message_handler(func=lambda m: bool(GET_CMD_REGEX.match(m.text or '')))
+@bot.message_handler(func=lambda m: (m.text or '').startswith(GET_CMD_PREFIX) and is_valid_code(m.text[len(GET_CMD_PREFIX):]))
+@per_chat
 def on_get_code_style(message):
-    code = GET_CMD_REGEX.match(message.text).group(1)
-    handle_retrieval(message, code)
+    handle_retrieval(message, message.text[len(GET_CMD_PREFIX):])
 
 @bot.message_handler(commands=['get'])
+@per_chat
 def on_get(message):
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) >= 2:
         code = parts[1]
         handle_retrieval(message, code)
@@ -169,6 +239,7 @@ def on_get(message):
         send_error(message.chat.id, 'Usage: /get <code> or /get_<code>')
 
 @bot.message_handler(commands=['my_files'])
+@per_chat
 def on_my_files(message):
     uid = message.from_user.id
     items = db.list_by_user(uid, limit=50)
@@ -179,8 +250,9 @@ def on_my_files(message):
     bot.send_message(message.chat.id, '<b>Your files:</b>\n' + '\n'.join(lines[:100]))
 
 @bot.message_handler(commands=['list'])
+@per_chat
 def on_list(message):
-    parts = (message.text or '').strip().lower().split()
+    parts = [p.lower() for p in message.tokens]
     if len(parts) < 2:
         bot.send_message(message.chat.id, 'Usage: /list images|videos|audio|documents|zip|other OR /list user <user_id>')
         return
@@ -209,6 +281,7 @@ def on_list(message):
         bot.send_message(message.chat.id, '<b>List:</b>\n' + '\n'.join(lines[:100]))
 
 @bot.message_handler(commands=['search'])
+@per_chat
 def on_search(message):
     parts = (message.text or '').strip().split(maxsplit=1)
     if len(parts) < 2:
@@ -222,8 +295,9 @@ def on_search(message):
     bot.send_message(message.chat.id, '<b>Results:</b>\n' + '\n'.join(lines[:100]))
 
 @bot.message_handler(commands=['lock_code'])
+@per_chat
 def on_lock_code(message):
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) < 2:
         bot.send_message(message.chat.id, 'Usage: /lock_code <code>')
         return
@@ -232,19 +306,23 @@ def on_lock_code(message):
     if not entry:
         send_error(message.chat.id)
         return
-    if entry.get('uploader') != message.from_user.id and not is_admin(message.from_user.id):
+    if entry.get('uploader') != message.from_user.id and not message.is_admin:
         bot.send_message(message.chat.id, 'Only the uploader or admin can lock this code.')
         return
     db.update_code(code, {'locked_to': message.from_user.id})
     bot.send_message(message.chat.id, f'🔒 Code <code>{code}</code> locked to you.')
 
 @bot.message_handler(commands=['rename_code'])
+@per_chat
 def on_rename_code(message):
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) < 3:
         bot.send_message(message.chat.id, 'Usage: /rename_code <old> <new>')
         return
     old, new = parts[1], parts[2]
+    if old in pending_storage:
+        bot.send_message(message.chat.id, 'This file is still being saved. Try again in a moment.')
+        return
     entry = db.get_code(old)
     if not entry:
         send_error(message.chat.id)
@@ -252,7 +330,7 @@ def on_rename_code(message):
     if db.has_code(new):
         bot.send_message(message.chat.id, 'New code already exists. Choose a different code.')
         return
-    if entry.get('uploader') != message.from_user.id and not is_admin(message.from_user.id):
+    if entry.get('uploader') != message.from_user.id and not message.is_admin:
         bot.send_message(message.chat.id, 'Only the uploader or admin can rename this code.')
         return
     ok = db.rename_code(old, new)
@@ -262,9 +340,10 @@ def on_rename_code(message):
         send_error(message.chat.id, 'Could not rename code.')
 
 @bot.message_handler(commands=['expire'])
+@per_chat
 def on_expire(message):
     # /expire <code> <duration|never|delete>
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) < 3:
         bot.send_message(message.chat.id, 'Usage: /expire <code> <24h|7d|30m|never|delete>')
         return
@@ -274,7 +353,7 @@ def on_expire(message):
         send_error(message.chat.id)
         return
     # Only uploader or admin can expire
-    if entry.get('uploader') != message.from_user.id and not is_admin(message.from_user.id):
+    if entry.get('uploader') != message.from_user.id and not message.is_admin:
         bot.send_message(message.chat.id, 'Only the uploader or admin can set expiry for this code.')
         return
     dt = parse_expiry(val)
@@ -292,27 +371,30 @@ def on_expire(message):
         bot.send_message(message.chat.id, f'⏳ Expiry for <code>{code}</code> set to never.')
     else:
         db.update_code(code, {'expires_at': dt})
-        bot.send_message(message.chat.id, f'⏳ Expiry for <code>{code}</code> set to {dt}.')
+        bot.send_message(message.chat.id, f'⏳ Expiry for <code>{code}</code> set to {fmt_epoch(dt)}.')
 
 @bot.message_handler(commands=['all_files_count'])
+@per_chat
 def on_files_count(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
     files, users = db.counts()
     bot.send_message(message.chat.id, f'Total files: <b>{files}</b>')
 
 @bot.message_handler(commands=['all_users_count'])
+@per_chat
 def on_users_count(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
     files, users = db.counts()
     bot.send_message(message.chat.id, f'Total users: <b>{users}</b>')
 
 @bot.message_handler(commands=['delete_code'])
+@per_chat
 def on_delete_code(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) < 2:
         bot.send_message(message.chat.id, 'Usage: /delete_code <code>')
         return
@@ -329,10 +411,11 @@ def on_delete_code(message):
     bot.send_message(message.chat.id, f'Deleted code <code>{code}</code>.')
 
 @bot.message_handler(commands=['delete_user'])
+@per_chat
 def on_delete_user(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
-    parts = (message.text or '').strip().split()
+    parts = message.tokens
     if len(parts) < 2:
         bot.send_message(message.chat.id, 'Usage: /delete_user <user_id>')
         return
@@ -345,168 +428,216 @@ def on_delete_user(message):
     bot.send_message(message.chat.id, f'Deleted user <code>{uid}</code> stats. (Files remain)')
 
 @bot.message_handler(commands=['storage_clean'])
+@per_chat
 def on_storage_clean(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
     # Remove expired files and delete from storage
     removed = 0
-    # Create a copy of codes list to avoid mutation during iteration
-    codes_snapshot = list(db.data.get('codes', {}).keys())
-    for code in codes_snapshot:
-        entry = db.get_code(code)
-        if entry and db.is_expired(entry):
-            try:
-                bot.delete_message(STORAGE_CHAT_ID, entry.get('storage_message_id'))
-            except Exception:
-                pass
-            db.delete_code(code)
-            removed += 1
+    for code, storage_message_id in db.expired_codes(now_epoch()):
+        try:
+            bot.delete_message(STORAGE_CHAT_ID, storage_message_id)
+        except Exception:
+            pass
+        db.delete_code(code)
+        removed += 1
     bot.send_message(message.chat.id, f'Cleaned expired files: <b>{removed}</b>')
 
 @bot.message_handler(commands=['broadcast'])
+@per_chat
 def on_broadcast(message):
-    if not is_admin(message.from_user.id):
+    if not message.is_admin:
         return
     parts = (message.text or '').strip().split(maxsplit=1)
     if len(parts) < 2:
         bot.send_message(message.chat.id, 'Usage: /broadcast <message>')
         return
-    text = parts[1]
-    sent = 0
-    for uid in db.all_users():
+    status = bot.send_message(message.chat.id, '📣 Broadcast started...')
+    # Run in the background so other updates are not blocked
+    threading.Thread(
+        target=broadcast_worker,
+        args=(message.chat.id, status.message_id, parts[1]),
+        daemon=True,
+    ).start()
+
+def broadcast_worker(chat_id: int, status_message_id: int, text: str):
+    users = db.all_users()
+
+    def send_one(uid: int) -> bool:
+        broadcast_limiter.acquire()
         try:
             bot.send_message(uid, text)
-            sent += 1
-            time.sleep(0.03)  # small delay to reduce flood risk
+            return True
         except Exception:
-            pass
-    bot.send_message(message.chat.id, f'Broadcast sent to <b>{sent}</b> users.')
+            return False
+
+    sent = 0
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as pool:
+        for done, ok in enumerate(pool.map(send_one, users), 1):
+            sent += ok
+            if done % BROADCAST_PROGRESS_EVERY == 0:
+                try:
+                    bot.edit_message_text(f'📣 Broadcasting... {done}/{len(users)}', chat_id, status_message_id)
+                except Exception:
+                    pass
+    bot.send_message(chat_id, f'Broadcast sent to <b>{sent}</b> users.')
 
 # --- Media/File Handlers with Anti-Spam ---
 def check_rate_limit(user_id: int) -> bool:
-    dq = rate_buckets[user_id]
-    now = time.time()
-    # purge old entries beyond window
-    while dq and (now - dq[0] > RATE_LIMIT_WINDOW_SEC):
-        dq.popleft()
-    if len(dq) >= RATE_LIMIT_MAX_FILES:
+    now = time.monotonic()  # immune to wall-clock jumps
+    _evict_idle_buckets(now)
+    tokens, last = rate_buckets.get(user_id, (RATE_LIMIT_MAX_FILES, now))
+    tokens = min(RATE_LIMIT_MAX_FILES, tokens + (now - last) * RATE_REFILL_PER_SEC)
+    if tokens < 1:
         return False
-    dq.append(now)
+    rate_buckets[user_id] = (tokens - 1, now)
     return True
 
+def _evict_idle_buckets(now: float):
+    # Lazily drop buckets idle for 2 windows (they are full again by then)
+    global _last_rate_evict
+    if now - _last_rate_evict < RATE_LIMIT_WINDOW_SEC:
+        return
+    _last_rate_evict = now
+    idle = [uid for uid, (_, last) in list(rate_buckets.items()) if now - last > 2 * RATE_LIMIT_WINDOW_SEC]
+    for uid in idle:
+        rate_buckets.pop(uid, None)
+
 def process_incoming_file(message, file_type: str):
     uid = message.from_user.id if message.from_user else 0
     if not check_rate_limit(uid):
         bot.send_message(message.chat.id, '⚠️ Slow down! You are sending too fast.')
         return
 
-    # Copy to storage group/channel
-    try:
-        copied = bot.copy_message(STORAGE_CHAT_ID, message.chat.id, message.message_id)
-        storage_message_id = copied.message_id if hasattr(copied, 'message_id') else copied
-    except Exception as e:
-        send_error(message.chat.id, '❌ Error: Could not save to storage group. Make sure the bot is admin there.')
-        return
-
     # Extract file_id and extra
-    file_id = None
-    mime_type = None
-    file_name = None
-    caption = message.caption
-
-    if file_type == 'photo' and message.photo:
-        # choose largest
-        photo = max(message.photo, key=lambda p: p.file_size or 0)
-        file_id = photo.file_id
-    elif file_type == 'video' and message.video:
-        file_id = message.video.file_id
-        mime_type = message.video.mime_type
-    elif file_type == 'document' and message.document:
-        file_id = message.document.file_id
-        mime_type = message.document.mime_type
-        file_name = message.document.file_name
-    elif file_type == 'audio' and message.audio:
-        file_id = message.audio.file_id
-        mime_type = message.audio.mime_type
-        file_name = message.audio.file_name
-    elif file_type == 'voice' and message.voice:
-        file_id = message.voice.file_id
-        mime_type = None
-    elif file_type == 'animation' and message.animation:
-        file_id = message.animation.file_id
-        mime_type = message.animation.mime_type
-    elif file_type == 'sticker' and message.sticker:
-        file_id = message.sticker.file_id
-    else:
+    media = getattr(message, file_type, None) if file_type in MEDIA_FIELDS else None
+    if not media and message.document:
         # fallback: treat as document
-        if message.document:
-            file_id = message.document.file_id
-            mime_type = message.document.mime_type
-            file_name = message.document.file_name
-            file_type = 'document'
+        file_type, media = 'document', message.document
+    if file_type == 'photo' and media:
+        # Telegram lists sizes in ascending order: last is the largest
+        media = media[-1]
+    keep_mime, keep_name = MEDIA_FIELDS.get(file_type, (False, False))
+    file_id = media.file_id if media else None
+    mime_type = media.mime_type if media and keep_mime else None
+    file_name = media.file_name if media and keep_name else None
+    caption = message.caption
 
     if not file_id:
         send_error(message.chat.id, '❌ Error: Could not capture file_id.')
         return
 
-    code = save_file_entry(uid, file_type, file_id, storage_message_id, mime_type, file_name, caption)
-    link = deep_link_for(code)
-    bot.send_message(message.chat.id, f'✅ Saved!\nCode: <code>{code}</code>\nRetrieve: <code>/get_{code}</code>\nLink: {link}')
+    # Reserve the code now; the storage copy is filled in by storage_worker
+    code = save_file_entry(uid, file_type, file_id, None, mime_type, file_name, caption)
+    fut = Future()
+    pending_storage[code] = fut
+    storage_queue.put((code, message.chat.id, message.message_id, fut))
+    bot.send_message(message.chat.id, SAVED_MSG_TMPL.format(code, DEEP_LINK_PREFIX))
 
 # Register media handlers
-@bot.message_handler(content_types=['photo'])
-def on_photo(message):
-    process_incoming_file(message, 'photo')
-
-@bot.message_handler(content_types=['video'])
-def on_video(message):
-    process_incoming_file(message, 'video')
-
-@bot.message_handler(content_types=['document'])
-def on_document(message):
-    process_incoming_file(message, 'document')
-
-@bot.message_handler(content_types=['audio'])
-def on_audio(message):
-    process_incoming_file(message, 'audio')
-
-@bot.message_handler(content_types=['voice'])
-def on_voice(message):
-    process_incoming_file(message, 'voice')
-
-@bot.message_handler(content_types=['animation'])
-def on_animation(message):
-    process_incoming_file(message, 'animation')
+def _media_handler(file_type: str):
+    def handler(message):
+        process_incoming_file(message, file_type)
+    handler.__name__ = f'on_{file_type}'
+    return handler
+
+for _file_type in MEDIA_FIELDS:
+    bot.register_message_handler(per_chat(_media_handler(_file_type)), content_types=[_file_type])
+
+# --- Background storage copier ---
+def _failed_to_connect(e: requests.ConnectionError) -> bool:
+    # requests wraps connect-phase failures as MaxRetryError(reason=...)
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+def copy_to_storage(chat_id: int, message_id: int) -> int:
+    """copy_message into storage, honoring 429 retry_after.
+    Otherwise only failures to connect are retried: nothing was sent yet.
+    Read timeouts and dropped connections may come after the copy was made.
+    """
+    delay = 1.0
+    for attempt in range(STORAGE_COPY_MAX_RETRIES + 1):
+        try:
+            copied = bot.copy_message(STORAGE_CHAT_ID, chat_id, message_id)
+            return copied.message_id if hasattr(copied, 'message_id') else copied
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 429 or attempt == STORAGE_COPY_MAX_RETRIES:
+                raise
+            retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+            time.sleep(retry_after or delay)
+        except requests.ConnectionError as e:
+            if not _failed_to_connect(e) or attempt == STORAGE_COPY_MAX_RETRIES:
+                raise
+            time.sleep(delay)
+        delay *= 2
+
+def storage_worker():
+    while True:
+        code, chat_id, message_id, fut = storage_queue.get()
+        try:
+            try:
+                storage_message_id = copy_to_storage(chat_id, message_id)
+            except Exception:
+                # Nothing was stored: drop the reserved code
+                send_error(chat_id, f'❌ Error: Could not save <code>{code}</code> to storage group. Make sure the bot is admin there.')
+                db.delete_code(code)
+                raise
+            if db.has_code(code):
+                db.update_code(code, {'storage_message_id': storage_message_id})
+            else:
+                # Deleted or expired while the copy was in flight
+                try:
+                    bot.delete_message(STORAGE_CHAT_ID, storage_message_id)
+                except Exception:
+                    pass
+            fut.set_result(storage_message_id)
+        except Exception as e:
+            # Keep the worker alive; later uploads still need it
+            telebot.logger.exception('Storage copy for %s failed', code)
+            if not fut.done():
+                fut.set_exception(e)
+        finally:
+            pending_storage.pop(code, None)
 
-@bot.message_handler(content_types=['sticker'])
-def on_sticker(message):
-    process_incoming_file(message, 'sticker')
+threading.Thread(target=storage_worker, daemon=True).start()
 
 # --- Background expiry checker ---
 def expiry_worker():
+    # Sleeps until the earliest deadline (capped at EXPIRE_CHECK_INTERVAL_SEC);
+    # db.expiry_changed wakes it early when a sooner expiry is set.
     while True:
+        db.expiry_changed.clear()
         try:
-            # Snapshot codes to avoid dict change during iteration
-            codes = list(db.data.get('codes', {}).keys())
-            for code in codes:
-                entry = db.get_code(code)
-                if not entry:
-                    continue
-                if db.is_expired(entry):
-                    try:
-                        bot.delete_message(STORAGE_CHAT_ID, entry.get('storage_message_id'))
-                    except Exception:
-                        pass
-                    db.delete_code(code)
+            for code, storage_message_id in db.expired_codes(now_epoch()):
+                try:
+                    bot.delete_message(STORAGE_CHAT_ID, storage_message_id)
+                except Exception:
+                    pass
+                db.delete_code(code)
             if DEBUG:
                 print('[ExpiryWorker] Sweep complete')
         except Exception as e:
             if DEBUG:
                 print('[ExpiryWorker] Exception', e)
-        time.sleep(EXPIRE_CHECK_INTERVAL_SEC)
+        timeout = EXPIRE_CHECK_INTERVAL_SEC
+        try:
+            due_in = db.next_expiry_in()
+            if due_in is not None:
+                timeout = min(timeout, max(due_in, 1))
+        except Exception:
+            pass
+        db.expiry_changed.wait(timeout)
 
 threading.Thread(target=expiry_worker, daemon=True).start()
 
+def _on_sigterm(signum, frame):
+    # Default SIGTERM handling skips atexit; exit normally so db.checkpoint runs
+    raise SystemExit(0)
+
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _on_sigterm)
     print('Bot starting...')
-    bot.infinity_polling(skip_pending=True, timeout=60)
+    # Each getUpdates batch (up to 100) is fanned out across the chat lanes
+    bot.infinity_polling(skip_pending=True, timeout=60, long_polling_timeout=50, allowed_updates=['message'])
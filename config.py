@@ -17,16 +17,35 @@ STORAGE_CHAT_ID = int(os.getenv('STORAGE_CHAT_ID', '-1003421567383'))
 
 # Owner/Admins
 OWNER_ID = int(os.getenv('OWNER_ID', '1972024725'))
-ADMIN_USER_IDS = set([OWNER_ID])
+ADMIN_USER_IDS = frozenset({OWNER_ID})
+
+# Handler concurrency: updates of one chat run in order, chats run in parallel
+CHAT_WORKERS = int(os.getenv('CHAT_WORKERS', '32'))
 
 # Rate limit: max files per window
 RATE_LIMIT_MAX_FILES = int(os.getenv('RATE_LIMIT_MAX_FILES', '3'))
 RATE_LIMIT_WINDOW_SEC = int(os.getenv('RATE_LIMIT_WINDOW_SEC', '10'))
 
+# Broadcast: Telegram allows ~30 messages/sec globally
+BROADCAST_RATE_PER_SEC = float(os.getenv('BROADCAST_RATE_PER_SEC', '30'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+
+# Retries for copying an upload into the storage chat (429s and network errors)
+STORAGE_COPY_MAX_RETRIES = int(os.getenv('STORAGE_COPY_MAX_RETRIES', '5'))
+
 # Expiry check interval (seconds)
 EXPIRE_CHECK_INTERVAL_SEC = int(os.getenv('EXPIRE_CHECK_INTERVAL_SEC', '600'))  # 10 minutes
 
-# Database path
+# Database path (SQLite)
+DB_PATH = os.getenv('DB_PATH', 'db.sqlite3')
+# Group-commit interval for database writes (0 = commit every write).
+# New codes are committed before they are sent to the user regardless.
+# A read arriving while writes are pending commits them early, so under
+# mixed traffic batches are smaller than this interval suggests.
+WRITEBACK_INTERVAL_SEC = float(os.getenv('WRITEBACK_INTERVAL_SEC', '1'))
+# ...or as soon as this many writes are pending
+WRITEBACK_MAX_PENDING = int(os.getenv('WRITEBACK_MAX_PENDING', '100'))
+# Legacy JSON database, imported into SQLite once on first start
 DB_JSON_PATH = os.getenv('DB_JSON_PATH', 'db.json')
 
 # Optional: turn on verbose logging
@@ -1,362 +1,595 @@
-
+import functools
 import json
+import logging
+import mmap
 import os
+import sqlite3
 import threading
-from typing import Optional, Dict, Any, List
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple, Callable, DefaultDict
 from datetime import datetime
 
-class Database:
-    """JSON-backed database with a future-friendly interface that can be
-    swapped to SQLite without changing bot logic.
-    Schema (JSON):
-    {
-      "codes": {
-        "12837": {
-          "file_id": "...",
-          "file_type": "photo",
-          "uploader": 12345566,
-          "uploaded_at": "2025-11-29 12:30",
-          "expires_at": null,
-          "storage_message_id": 123,
-          "category": "Images",
-          "locked_to": null,
-          "file_name": null,
-          "caption": null,
-          "mime_type": null
-        }
-      },
-      "users": {
-        "12345566": {
-          "uploads": 55,
-          "retrieved": 210
-        }
-      }
-    }
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is the fallback
+    orjson = None
+
+# Column order of the codes table (excluding the primary key)
+CODE_FIELDS = (
+    'file_id', 'file_type', 'uploader', 'uploaded_at', 'expires_at',
+    'storage_message_id', 'category', 'locked_to', 'file_name', 'caption',
+    'mime_type',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS codes (
+    code TEXT PRIMARY KEY,
+    uploader INTEGER,
+    uploaded_at INTEGER,
+    expires_at INTEGER NULL,
+    storage_message_id INTEGER,
+    category TEXT,
+    locked_to INTEGER NULL,
+    file_id TEXT,
+    file_type TEXT,
+    mime_type TEXT,
+    file_name TEXT,
+    caption TEXT,
+    search_text TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_codes_uploader_time ON codes(uploader, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS idx_codes_category_time ON codes(category, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS idx_codes_expires ON codes(expires_at) WHERE expires_at IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    uploads INTEGER NOT NULL DEFAULT 0,
+    retrieved INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Fields that, with the code itself, make up an entry's search_text
+SEARCH_FIELDS = ('file_type', 'file_name', 'caption', 'mime_type')
+
+
+def search_text(code: str, entry: Dict[str, Any]) -> str:
+    """Lowercased haystack search_codes matches against, precomputed per row."""
+    return ' '.join([code, *(entry.get(k) or '' for k in SEARCH_FIELDS)]).lower()
+
+
+# Trigram full-text index so substring search does not scan every row.
+# Kept in sync with codes by triggers (rowid of codes_fts == rowid of codes).
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS codes_fts USING fts5(hay, tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS codes_fts_ai AFTER INSERT ON codes BEGIN
+    INSERT INTO codes_fts(rowid, hay) VALUES (new.rowid, new.search_text);
+END;
+CREATE TRIGGER IF NOT EXISTS codes_fts_ad AFTER DELETE ON codes BEGIN
+    DELETE FROM codes_fts WHERE rowid = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS codes_fts_au AFTER UPDATE OF search_text ON codes BEGIN
+    UPDATE codes_fts SET hay = new.search_text WHERE rowid = new.rowid;
+END;
+"""
+
+# Trigram tokens are 3 characters; shorter queries fall back to a scan
+FTS_MIN_QUERY_LEN = 3
+
+_SELECT_COLS = ', '.join(CODE_FIELDS)
+_LIST_KEYS = ('code', *CODE_FIELDS)
+_INSERT_SQL = (
+    f'INTO codes (code, {_SELECT_COLS}, search_text) '
+    f'VALUES ({", ".join("?" * (len(CODE_FIELDS) + 2))})'
+)
+
+
+def _insert_params(code: str, entry: Dict[str, Any]) -> Tuple:
+    return (code, *(entry.get(k) for k in CODE_FIELDS), search_text(code, entry))
+
+
+# Columns holding Unix epoch seconds; the legacy JSON store kept these as text
+EPOCH_FIELDS = ('uploaded_at', 'expires_at')
+LEGACY_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M')
+
+
+def _legacy_epoch(value: Any) -> Optional[int]:
+    """Epoch seconds for a legacy JSON timestamp (text or already numeric)."""
+    if value is None or isinstance(value, int):
+        return value
+    for fmt in LEGACY_TIME_FORMATS:
+        try:
+            return int(datetime.strptime(value, fmt).timestamp())
+        except (TypeError, ValueError):
+            pass
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _RWLock:
+    """Many concurrent readers or one re-entrant writer; waiting writers go first.
+    `with lock:` takes the write side, so it drops in for an RLock.
     """
 
-    def __init__(self, path: str):
-        self.path = path
-        self._lock = threading.RLock()
-        self.data = {"codes": {}, "users": {}}
-        self._load()
-
-    def _load(self):
-        with self._lock:
-            if os.path.exists(self.path):
-                try:
-                    with open(self.path, 'r', encoding='utf-8') as f:
-                        self.data = json.load(f)
-                except Exception:
-                    # If corrupt, back it up and start fresh
-                    try:
-                        os.rename(self.path, self.path + '.corrupt.bak')
-                    except Exception:
-                        pass
-                    self.data = {"codes": {}, "users": {}}
-                    self._save()
-            else:
-                self._save()
-
-    def _save(self):
-        with self._lock:
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
-
-    # --- Code entries ---
-    def has_code(self, code: str) -> bool:
-        with self._lock:
-            return code in self.data["codes"]
-
-    def put_code(self, code: str, entry: Dict[str, Any]):
-        with self._lock:
-            self.data["codes"][code] = entry
-            self._save()
-
-    def get_code(self, code: str) -> Optional[Dict[str, Any]]:
-        with self._lock:
-            return self.data["codes"].get(code)
-
-    def update_code(self, code: str, patch: Dict[str, Any]):
-        with self._lock:
-            if code in self.data["codes"]:
-                self.data["codes"][code].update(patch)
-                self._save()
-
-    def delete_code(self, code: str):
-        with self._lock:
-            if code in self.data["codes"]:
-                del self.data["codes"][code]
-                self._save()
-
-    def rename_code(self, old: str, new: str) -> bool:
-        with self._lock:
-            if old in self.data["codes"] and new not in self.data["codes"]:
-                self.data["codes"][new] = self.data["codes"].pop(old)
-                self._save()
-                return True
-            return False
-
-    def list_by_category(self, category: str, limit: int = 50) -> List[Dict[str, Any]]:
-        with self._lock:
-            results = [
-                {"code": c, **e} for c, e in self.data["codes"].items()
-                if e.get("category") == category
-            ]
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
-
-    def list_by_user(self, user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-        with self._lock:
-            results = [
-                {"code": c, **e} for c, e in self.data["codes"].items()
-                if e.get("uploader") == user_id
-            ]
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
-
-    def search_codes(self, query: str, limit: int = 50) -> List[Dict[str, Any]]:
-        q = query.lower()
-        with self._lock:
-            results = []
-            for c, e in self.data["codes"].items():
-                hay = ' '.join([
-                    c,
-                    e.get("file_type") or '',
-                    e.get("file_name") or '',
-                    e.get("caption") or '',
-                    e.get("mime_type") or '',
-                ]).lower()
-                if q in hay:
-                    z = {"code": c, **e}
-                    results.append(z)
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
-
-    # --- Users ---
-    def ensure_user(self, user_id: int):
-        uid = str(user_id)
-        with self._lock:
-            if uid not in self.data["users"]:
-                self.data["users"][uid] = {"uploads": 0, "retrieved": 0}
-                self._save()
-
-    def inc_upload(self, user_id: int, by: int = 1):
-        uid = str(user_id)
-        with self._lock:
-            self.ensure_user(user_id)
-            self.data["users"][uid]["uploads"] += by
-            self._save()
-
-    def inc_retrieved(self, user_id: int, by: int = 1):
-        uid = str(user_id)
-        with self._lock:
-            self.ensure_user(user_id)
-            self.data["users"][uid]["retrieved"] += by
-            self._save()
-
-    def delete_user(self, user_id: int):
-        uid = str(user_id)
-        with self._lock:
-            if uid in self.data["users"]:
-                del self.data["users"][uid]
-                self._save()
-
-    def all_users(self) -> List[int]:
-        with self._lock:
-            return [int(uid) for uid in self.data["users"].keys()]
-
-    def counts(self):
-        with self._lock:
-            return len(self.data["codes"]), len(self.data["users"])  # files, users
-
-    # Utility
-    def is_expired(self, entry: Dict[str, Any]) -> bool:
-        exp = entry.get("expires_at")
-        if not exp:
-            return False
-        try:
-            dt = datetime.strptime(exp, "%Y-%m-%d %H:%M:%S")
-            return dt <= datetime.now()
-        except Exception:
-            return False
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._depth = 0
+        self._writers_waiting = 0
+
+    def owned(self) -> bool:
+        return self._writer == threading.get_ident()
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            self._writers_waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Let SQLite read database pages straight from a shared mapping
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+def _load_json(path: str) -> Any:
+    """Parse a JSON file; with orjson, straight from an mmap (no str copy)."""
+    with open(path, 'rb') as f:
+        if orjson is None:
+            return json.loads(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+
+# Listing/search results cache (cleared on every code mutation)
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_TTL_SEC = 30
+
+# Upload/retrieval counters are summed in memory and written out this often
+# (or with the write-behind flush, when that runs sooner)
+USER_COUNTER_FLUSH_SEC = 5
+_UPSERT_USER_COUNTERS = (
+    'INSERT INTO users (user_id, uploads, retrieved) VALUES (?, ?, ?) '
+    'ON CONFLICT(user_id) DO UPDATE SET uploads = uploads + excluded.uploads, '
+    'retrieved = retrieved + excluded.retrieved'
+)
+
+
+def _cached_query(method):
+    """Serve repeated calls with the same arguments from Database._qcache."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self._qcache_lock:
+            hit = self._qcache.get(key)
+            if hit is not None and now - hit[0] < QUERY_CACHE_TTL_SEC:
+                self._qcache.move_to_end(key)
+                return hit[1]
+            gen = self._qcache_gen
+        result = method(self, *args, **kwargs)
+        with self._qcache_lock:
+            # Skip storing if a mutation invalidated the cache meanwhile
+            if gen == self._qcache_gen:
+                self._qcache[key] = (now, result)
+                self._qcache.move_to_end(key)
+                if len(self._qcache) > QUERY_CACHE_SIZE:
+                    self._qcache.popitem(last=False)
+        return result
+    return wrapper
 
-import json
-import os
-import threading
-from typing import Optional, Dict, Any, List
-from datetime import datetime
 
 class Database:
-    """JSON-backed database with a future-friendly interface that can be
-    swapped to SQLite without changing bot logic.
-    Schema (JSON):
-    {
-      "codes": {
-        "12837": {
-          "file_id": "...",
-          "file_type": "photo",
-          "uploader": 12345566,
-          "uploaded_at": "2025-11-29 12:30",
-          "expires_at": null,
-          "storage_message_id": 123,
-          "category": "Images",
-          "locked_to": null,
-          "file_name": null,
-          "caption": null,
-          "mime_type": null
-        }
-      },
-      "users": {
-        "12345566": {
-          "uploads": 55,
-          "retrieved": 210
-        }
-      }
-    }
+    """SQLite-backed database. Keeps the same interface the JSON store had,
+    so bot logic does not depend on the storage engine.
+    Tables:
+      codes(code PRIMARY KEY, file_id, file_type, uploader, uploaded_at,
+            expires_at, storage_message_id, category, locked_to,
+            file_name, caption, mime_type, search_text)
+      users(user_id PRIMARY KEY, uploads, retrieved)
+    search_text is the lowercased code/type/name/caption/mime haystack, kept
+    up to date on every write; codes_fts is a trigram FTS5 index over it.
+    uploaded_at and expires_at are Unix epoch seconds, so listings order and
+    expiry checks compare integers (and can use the indexes).
+    An existing JSON database (legacy_json_path) is imported once on first start.
+    list_by_*/search_codes results are cached briefly and dropped on any code change.
+    Writes can be group-committed (writeback_interval), and user counters are
+    buffered in memory between flushes; call flush() before exit.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None,
+                 writeback_interval: float = 0, writeback_max_pending: int = 100):
         self.path = path
-        self._lock = threading.RLock()
-        self.data = {"codes": {}, "users": {}}
-        self._load()
-
-    def _load(self):
-        with self._lock:
-            if os.path.exists(self.path):
+        # Writers hold this exclusively; readers share it (see _read)
+        self._lock = _RWLock()
+        # Group commit: with writeback_interval > 0, writes stay in one open
+        # transaction that a background flusher commits every interval, or
+        # right away once writeback_max_pending writes have piled up. New codes
+        # (insert_new_code) are always committed before they are returned.
+        self._writeback_interval = writeback_interval
+        self._writeback_max_pending = writeback_max_pending
+        self._pending = 0
+        # Pending [uploads, retrieved] increments per user; also guards _user_ids
+        self._user_deltas: DefaultDict[int, List[int]] = defaultdict(lambda: [0, 0])
+        self._counter_lock = threading.Lock()
+        self._qcache: 'OrderedDict[tuple, Tuple[float, List[Dict[str, Any]]]]' = OrderedDict()
+        self._qcache_lock = threading.Lock()
+        self._qcache_gen = 0
+        # Per-thread read-only connections; WAL lets them read in parallel
+        self._readers = threading.local()
+        # Set whenever an expiry is added, so the expiry worker can re-plan its sleep
+        self.expiry_changed = threading.Event()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        # Writes append to the -wal log, which SQLite folds into the main file
+        # every ~1000 pages (its default); cap what the log keeps on disk at 4 MiB.
+        self._conn.execute(f'PRAGMA journal_size_limit={4 * 1024 * 1024}')
+        # INSERT OR REPLACE must fire the delete trigger for the replaced row
+        self._conn.execute('PRAGMA recursive_triggers=ON')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+        self._import_legacy_json(legacy_json_path)
+        self._fts = self._init_fts()
+        # User ids kept in memory so broadcasts and counts don't enumerate the table
+        self._user_ids = {r[0] for r in self._conn.execute('SELECT user_id FROM users')}
+        threading.Thread(target=self._writeback_worker, daemon=True).start()
+
+    def _init_fts(self) -> bool:
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'codes_fts'"
+        ).fetchone() is not None
+        try:
+            self._conn.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5/trigram: search_codes scans instead
+            return False
+        if not exists:
+            with self._conn:
+                self._conn.execute(
+                    'INSERT INTO codes_fts(rowid, hay) SELECT rowid, search_text FROM codes'
+                )
+        return True
+
+    def _import_legacy_json(self, json_path: Optional[str]):
+        with self._lock:
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= 1:
+                return
+            data = {}
+            if json_path and os.path.exists(json_path):
                 try:
-                    with open(self.path, 'r', encoding='utf-8') as f:
-                        self.data = json.load(f)
+                    data = _load_json(json_path)
                 except Exception:
                     # If corrupt, back it up and start fresh
                     try:
-                        os.rename(self.path, self.path + '.corrupt.bak')
+                        os.replace(json_path, json_path + '.corrupt.bak')
                     except Exception:
                         pass
-                    self.data = {"codes": {}, "users": {}}
-                    self._save()
-            else:
-                self._save()
+            # Rows and the user_version marker commit together: a crash
+            # mid-import leaves nothing behind and the import simply reruns.
+            self._conn.execute('BEGIN')
+            with self._conn:
+                self._conn.executemany(
+                    f'INSERT OR IGNORE {_INSERT_SQL}',
+                    [
+                        _insert_params(code, {**e, **{k: _legacy_epoch(e.get(k)) for k in EPOCH_FIELDS}})
+                        for code, e in (data.get('codes') or {}).items()
+                    ],
+                )
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO users (user_id, uploads, retrieved) VALUES (?, ?, ?)',
+                    [
+                        (int(uid), u.get('uploads', 0), u.get('retrieved', 0))
+                        for uid, u in (data.get('users') or {}).items()
+                    ],
+                )
+                self._conn.execute('PRAGMA user_version = 1')
+
+    @contextmanager
+    def _write(self, sync: bool = False):
+        """Write transaction; sync=True commits now even under group commit."""
+        with self._lock:
+            yield
+            if sync or self._writeback_interval <= 0:
+                self._conn.commit()
+                self._pending = 0
+                return
+            self._pending += 1
+            if self._pending >= self._writeback_max_pending:
+                self.flush()
+
+    def _writeback_worker(self):
+        interval = USER_COUNTER_FLUSH_SEC
+        if self._writeback_interval > 0:
+            interval = min(interval, self._writeback_interval)
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+
+    def flush(self):
+        """Commit batched writes and buffered user counters. Call on shutdown."""
+        with self._lock:
+            with self._counter_lock:
+                deltas, self._user_deltas = self._user_deltas, defaultdict(lambda: [0, 0])
+            written = False
+            try:
+                if deltas:
+                    self._upsert_user_deltas(deltas)
+                    written = True
+                if self._pending or deltas:
+                    self._conn.commit()
+                    self._pending = 0
+            except Exception:
+                # Increments still in the open transaction go out with the next
+                # commit; otherwise put them back so the next flush retries them
+                if not (written and self._conn.in_transaction):
+                    self._merge_user_deltas(deltas)
+                raise
+
+    def _upsert_user_deltas(self, deltas: Dict[int, List[int]]):
+        # All or nothing, without touching other writes pending in the transaction
+        self._conn.execute('SAVEPOINT user_counters')
+        try:
+            self._conn.executemany(
+                _UPSERT_USER_COUNTERS, [(uid, up, rt) for uid, (up, rt) in deltas.items()]
+            )
+        except Exception:
+            self._conn.execute('ROLLBACK TO user_counters')
+            raise
+        finally:
+            self._conn.execute('RELEASE user_counters')
+
+    def _merge_user_deltas(self, deltas: Dict[int, List[int]]):
+        with self._counter_lock:
+            for uid, (up, rt) in deltas.items():
+                counters = self._user_deltas[uid]
+                counters[0] += up
+                counters[1] += rt
+
+    def checkpoint(self):
+        """Flush pending writes and fold the WAL into the main database file."""
+        with self._lock:
+            self.flush()
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _invalidate_queries(self):
+        with self._qcache_lock:
+            self._qcache.clear()
+            self._qcache_gen += 1
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA query_only=ON')
+            conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+            self._readers.conn = conn
+        return conn
+
+    @contextmanager
+    def _read(self):
+        """Connection for a read-only query.
+        Readers share the lock and each use their own connection, so they run
+        in parallel. Group-committed writes still pending are committed first
+        so readers see them; this thread's own writes are therefore always
+        visible. The writer thread itself reads through the writer connection.
+        """
+        if self._lock.owned():
+            with self._lock:
+                yield self._conn
+            return
+        if self._pending:
+            self.flush()
+        self._lock.acquire_read()
+        try:
+            yield self._reader()
+        finally:
+            self._lock.release_read()
 
-    def _save(self):
-        with self._lock:
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+    @staticmethod
+    def _row_to_entry(row) -> Dict[str, Any]:
+        return dict(zip(CODE_FIELDS, row))
 
     # --- Code entries ---
     def has_code(self, code: str) -> bool:
-        with self._lock:
-            return code in self.data["codes"]
+        with self._read() as conn:
+            cur = conn.execute('SELECT 1 FROM codes WHERE code = ?', (code,))
+            return cur.fetchone() is not None
 
     def put_code(self, code: str, entry: Dict[str, Any]):
-        with self._lock:
-            self.data["codes"][code] = entry
-            self._save()
+        with self._write():
+            self._conn.execute(f'INSERT OR REPLACE {_INSERT_SQL}', _insert_params(code, entry))
+            self._invalidate_queries()
+        if entry.get('expires_at'):
+            self.expiry_changed.set()
+
+    def insert_new_code(self, entry: Dict[str, Any], gen_code: Callable[[], str]) -> str:
+        """Store entry under a fresh code from gen_code() and return the code.
+        Uniqueness is enforced by the primary key, so each attempt is one
+        statement; a collision just draws another code.
+        Committed before returning, since the code is handed to the user.
+        """
+        while True:
+            code = gen_code()
+            with self._write(sync=True):
+                cur = self._conn.execute(
+                    f'INSERT {_INSERT_SQL} ON CONFLICT(code) DO NOTHING',
+                    _insert_params(code, entry),
+                )
+            if cur.rowcount == 1:
+                self._invalidate_queries()
+                break
+        if entry.get('expires_at'):
+            self.expiry_changed.set()
+        return code
 
     def get_code(self, code: str) -> Optional[Dict[str, Any]]:
-        with self._lock:
-            return self.data["codes"].get(code)
+        with self._read() as conn:
+            row = conn.execute(
+                f'SELECT {_SELECT_COLS} FROM codes WHERE code = ?', (code,)
+            ).fetchone()
+            return self._row_to_entry(row) if row else None
 
     def update_code(self, code: str, patch: Dict[str, Any]):
-        with self._lock:
-            if code in self.data["codes"]:
-                self.data["codes"][code].update(patch)
-                self._save()
+        fields = [k for k in patch if k in CODE_FIELDS]
+        if not fields:
+            return
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        with self._write():
+            self._conn.execute(
+                f'UPDATE codes SET {assignments} WHERE code = ?',
+                (*(patch[k] for k in fields), code),
+            )
+            if any(k in SEARCH_FIELDS for k in fields):
+                self._refresh_search_text(code)
+            self._invalidate_queries()
+        if patch.get('expires_at'):
+            self.expiry_changed.set()
 
     def delete_code(self, code: str):
-        with self._lock:
-            if code in self.data["codes"]:
-                del self.data["codes"][code]
-                self._save()
+        with self._write():
+            self._conn.execute('DELETE FROM codes WHERE code = ?', (code,))
+            self._invalidate_queries()
 
     def rename_code(self, old: str, new: str) -> bool:
         with self._lock:
-            if old in self.data["codes"] and new not in self.data["codes"]:
-                self.data["codes"][new] = self.data["codes"].pop(old)
-                self._save()
-                return True
-            return False
-
+            if not self.has_code(old) or self.has_code(new):
+                return False
+            with self._write():
+                self._conn.execute('UPDATE codes SET code = ? WHERE code = ?', (new, old))
+                self._refresh_search_text(new)
+                self._invalidate_queries()
+            return True
+
+    def _refresh_search_text(self, code: str):
+        entry = self.get_code(code)
+        if entry is not None:
+            self._conn.execute(
+                'UPDATE codes SET search_text = ? WHERE code = ?', (search_text(code, entry), code)
+            )
+
+    def _list(self, where: str, params: Tuple, limit: int) -> List[Dict[str, Any]]:
+        with self._read() as conn:
+            rows = conn.execute(
+                f'SELECT code, {_SELECT_COLS} FROM codes WHERE {where} '
+                f'ORDER BY uploaded_at DESC LIMIT ?',
+                (*params, limit),
+            ).fetchall()
+        # One dict per returned row, keyed straight off the selected columns
+        return [dict(zip(_LIST_KEYS, r)) for r in rows]
+
+    @_cached_query
     def list_by_category(self, category: str, limit: int = 50) -> List[Dict[str, Any]]:
-        with self._lock:
-            results = [
-                {"code": c, **e} for c, e in self.data["codes"].items()
-                if e.get("category") == category
-            ]
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
+        return self._list('category = ?', (category,), limit)
 
+    @_cached_query
     def list_by_user(self, user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-        with self._lock:
-            results = [
-                {"code": c, **e} for c, e in self.data["codes"].items()
-                if e.get("uploader") == user_id
-            ]
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
+        return self._list('uploader = ?', (user_id,), limit)
 
+    @_cached_query
     def search_codes(self, query: str, limit: int = 50) -> List[Dict[str, Any]]:
-        q = query.lower()
-        with self._lock:
-            results = []
-            for c, e in self.data["codes"].items():
-                hay = ' '.join([
-                    c,
-                    e.get("file_type") or '',
-                    e.get("file_name") or '',
-                    e.get("caption") or '',
-                    e.get("mime_type") or '',
-                ]).lower()
-                if q in hay:
-                    z = {"code": c, **e}
-                    results.append(z)
-            results.sort(key=lambda x: x.get("uploaded_at") or "", reverse=True)
-            return results[:limit]
+        if self._fts and len(query) >= FTS_MIN_QUERY_LEN:
+            # Quoted as a phrase: consecutive trigrams == case-insensitive substring
+            phrase = '"' + query.replace('"', '""') + '"'
+            return self._list(
+                'rowid IN (SELECT rowid FROM codes_fts WHERE hay MATCH ?)', (phrase,), limit
+            )
+        return self._list('instr(search_text, ?) > 0', (query.lower(),), limit)
+
+    def expired_codes(self, now: int) -> List[Tuple[str, Optional[int]]]:
+        """(code, storage_message_id) of entries whose expiry is at or before now."""
+        with self._read() as conn:
+            return conn.execute(
+                'SELECT code, storage_message_id FROM codes WHERE expires_at <= ?', (now,)
+            ).fetchall()
+
+    def next_expiry_in(self) -> Optional[float]:
+        """Seconds until the earliest pending expiry (may be <= 0), or None."""
+        with self._read() as conn:
+            exp = conn.execute(
+                'SELECT MIN(expires_at) FROM codes WHERE expires_at IS NOT NULL'
+            ).fetchone()[0]
+        if exp is None:
+            return None
+        return exp - time.time()
 
     # --- Users ---
     def ensure_user(self, user_id: int):
-        uid = str(user_id)
-        with self._lock:
-            if uid not in self.data["users"]:
-                self.data["users"][uid] = {"uploads": 0, "retrieved": 0}
-                self._save()
+        with self._write():
+            self._conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            with self._counter_lock:
+                self._user_ids.add(user_id)
 
     def inc_upload(self, user_id: int, by: int = 1):
-        uid = str(user_id)
-        with self._lock:
-            self.ensure_user(user_id)
-            self.data["users"][uid]["uploads"] += by
-            self._save()
+        # Buffered; the row is written (or created) by the next flush()
+        with self._counter_lock:
+            self._user_deltas[user_id][0] += by
+            self._user_ids.add(user_id)
 
     def inc_retrieved(self, user_id: int, by: int = 1):
-        uid = str(user_id)
-        with self._lock:
-            self.ensure_user(user_id)
-            self.data["users"][uid]["retrieved"] += by
-            self._save()
+        with self._counter_lock:
+            self._user_deltas[user_id][1] += by
+            self._user_ids.add(user_id)
 
     def delete_user(self, user_id: int):
-        uid = str(user_id)
-        with self._lock:
-            if uid in self.data["users"]:
-                del self.data["users"][uid]
-                self._save()
+        with self._write():
+            self._conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            with self._counter_lock:
+                self._user_deltas.pop(user_id, None)
+                self._user_ids.discard(user_id)
 
     def all_users(self) -> List[int]:
-        with self._lock:
-            return [int(uid) for uid in self.data["users"].keys()]
+        with self._counter_lock:
+            return list(self._user_ids)
 
     def counts(self):
-        with self._lock:
-            return len(self.data["codes"]), len(self.data["users"])  # files, users
+        with self._read() as conn:
+            files = conn.execute('SELECT COUNT(*) FROM codes').fetchone()[0]
+        with self._counter_lock:
+            return files, len(self._user_ids)  # files, users
 
     # Utility
     def is_expired(self, entry: Dict[str, Any]) -> bool:
         exp = entry.get("expires_at")
-        if not exp:
-            return False
-        try:
-            dt = datetime.strptime(exp, "%Y-%m-%d %H:%M:%S")
-            return dt <= datetime.now()
-        except Exception:
-            return False
+        return exp is not None and exp <= time.time()
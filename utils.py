@@ -1,8 +1,13 @@
 
-import random
+import functools
+import os
+import re
 import string
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Tuple, Union
 
 CATEGORIES = {
     'photo': 'Images',
@@ -15,17 +20,48 @@ CATEGORIES = {
     'sticker': 'Other',
 }
 
-ZIP_MIME_TYPES = {'application/zip', 'application/x-zip-compressed'}
+ZIP_MIME_TYPES = frozenset({'application/zip', 'application/x-zip-compressed'})
 
-def gen_code(length: int = 6) -> str:
-    # Alphanumeric code for better uniqueness
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+# Codes stay within [a-zA-Z0-9] so /get_<code> and deep links keep matching
+CODE_ALPHABET = string.ascii_letters + string.digits
 
-def now_str() -> str:
-    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+# os.urandom bytes map onto the alphabet via translate(); bytes >= 248
+# (62 * 4) are dropped so every character stays equally likely.
+_CODE_LIMIT = 256 - 256 % len(CODE_ALPHABET)
+_CODE_TABLE = bytes(CODE_ALPHABET.encode()[b % len(CODE_ALPHABET)] if b < _CODE_LIMIT else 0
+                    for b in range(256))
+_CODE_REJECT = bytes(range(_CODE_LIMIT, 256))
 
-def parse_expiry(value: str) -> Optional[str]:
-    """Parse human duration like '24h', '7d', '30m', 'never'. Return datetime string or None.
+def gen_code(length: int = 8) -> str:
+    # 8 base62 chars ~ 47.6 bits: collisions stay negligible well past 1M codes
+    out = b''
+    while len(out) < length:
+        out += os.urandom(length + 2).translate(_CODE_TABLE, _CODE_REJECT)
+    return out[:length].decode('ascii')
+
+def is_valid_code(code: str) -> bool:
+    # Same as [a-zA-Z0-9]+ without going through the regex engine
+    return code.isascii() and code.isalnum()
+
+def now_epoch() -> int:
+    return int(time.time())
+
+def fmt_epoch(ts: int) -> str:
+    """Local '%Y-%m-%d %H:%M:%S' rendering of epoch seconds, for display."""
+    try:
+        return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    except (ValueError, OverflowError, OSError):
+        # Outside what datetime can represent; show the raw value
+        return str(ts)
+
+# '<n>' plus an optional unit; a bare number means minutes
+_EXP_RE = re.compile(r'(\d+)([hdm]?)')
+_EXP_MULT = {'h': 3600, 'd': 86400, 'm': 60, '': 60}
+# Longer durations are treated like 'never'
+_EXP_MAX_SEC = 100 * 365 * 86400
+
+def parse_expiry(value: str) -> Optional[Union[int, str]]:
+    """Parse human duration like '24h', '7d', '30m', 'never'. Return epoch seconds or None.
     If value == 'delete', returns the string 'delete' to signal deletion.
     """
     v = (value or '').strip().lower()
@@ -33,43 +69,68 @@ def parse_expiry(value: str) -> Optional[str]:
         return None
     if v == 'delete':
         return 'delete'
-    try:
-        if v.endswith('h'):
-            hours = int(v[:-1])
-            dt = datetime.now() + timedelta(hours=hours)
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        elif v.endswith('d'):
-            days = int(v[:-1])
-            dt = datetime.now() + timedelta(days=days)
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        elif v.endswith('m'):
-            minutes = int(v[:-1])
-            dt = datetime.now() + timedelta(minutes=minutes)
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            # Fallback: treat as minutes if numeric
-            minutes = int(v)
-            dt = datetime.now() + timedelta(minutes=minutes)
-            return dt.strftime('%Y-%m-%d %H:%M:%S')
-    except Exception:
+    m = _EXP_RE.fullmatch(v)
+    if not m:
         return None
+    seconds = int(m.group(1)) * _EXP_MULT[m.group(2)]
+    if seconds > _EXP_MAX_SEC:
+        return None
+    return int(time.time()) + seconds
 
-def detect_category(file_type: str, mime_type: Optional[str], file_name: Optional[str]) -> str:
-    ft = (file_type or '').lower()
-    if ft in CATEGORIES:
-        cat = CATEGORIES[ft]
-    else:
-        cat = 'Other'
-
+@functools.lru_cache(maxsize=1024)
+def _detect_category(file_type: Optional[str], mime_type: Optional[str], zip_name: bool) -> str:
     # Special case: zip
-    if mime_type and mime_type.lower() in ZIP_MIME_TYPES:
-        return 'Zip'
-    if file_name and file_name.lower().endswith('.zip'):
+    if zip_name or (mime_type and mime_type.lower() in ZIP_MIME_TYPES):
         return 'Zip'
-    return cat
+    return CATEGORIES.get((file_type or '').lower(), 'Other')
+
+def detect_category(file_type: str, mime_type: Optional[str], file_name: Optional[str]) -> str:
+    # Only the extension is lowercased; the rest is cached per (type, mime)
+    zip_name = bool(file_name) and file_name[-4:].lower() == '.zip'
+    return _detect_category(file_type, mime_type, zip_name)
 
 def format_entry_line(code: str, entry: dict) -> str:
-    exp = entry.get('expires_at') or 'never'
+    exp = entry.get('expires_at')
+    exp = fmt_epoch(exp) if exp is not None else 'never'
     cat = entry.get('category') or 'Other'
     name = entry.get('file_name') or ''
     return f"{code} | {entry.get('file_type')} | {cat} | exp: {exp} | {name}"
+
+class RateLimiter:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`.
+    acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ChatLanes:
+    """Fixed set of single-thread lanes keyed by chat id.
+    Work for one chat runs in FIFO order; different chats run in parallel.
+    """
+
+    def __init__(self, lanes: int):
+        self._lanes = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'chat-lane-{i}')
+            for i in range(max(1, lanes))
+        ]
+
+    def submit(self, chat_id: int, fn, *args, **kwargs) -> Future:
+        return self._lanes[hash(chat_id) % len(self._lanes)].submit(fn, *args, **kwargs)